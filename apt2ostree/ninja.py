@@ -1,17 +1,37 @@
+import atexit
 import errno
+import functools
 import hashlib
+import io
 import os
 import re
 import shlex
 import sys
 import textwrap
-import traceback
 
 from . import ninja_syntax
 
+try:
+    # blake3 is considerably cheaper than sha256 and we only use these hashes
+    # to detect duplicate build statements:
+    from blake3 import blake3 as _HASH
+except ImportError:
+    _HASH = hashlib.sha256
+
 NINJA_AUTO_VARS = set(["in", "out", "_args_digest"])
 ALREADY_WRITTEN = "ALREADY_WRITTEN"
 
+# Tokenises $-escapes: $$, $var, ${var} and (in the last group) bad escapes.
+# $ at the end of a line is a line continuation so is allowed.  Ninja variable
+# names are ASCII only:
+_TOKEN_RE = re.compile(r"\$\$|\$(\w+)|\$\{(\w+)\}|\$([^_{0-9a-zA-Z\n])",
+                       re.ASCII)
+
+# Formatting the full stack for every build statement is expensive, so by
+# default we only record the first caller from outside this module.  Set
+# APT2OSTREE_DEBUG_STACKS=1 to get the full stack:
+_DEBUG_STACKS = os.environ.get("APT2OSTREE_DEBUG_STACKS") == "1"
+
 
 class Ninja(ninja_syntax.Writer):
     builddir = "_build"
@@ -25,12 +45,17 @@ class Ninja(ninja_syntax.Writer):
         self.ninjafile = ninjafile
         self.standalone = standalone
 
-        output = open(self.ninjafile + '~', 'w')
-        super(Ninja, self).__init__(output, width)
+        # The output is made up of many small writes so we buffer it in
+        # memory and write it out in one go in close():
+        super(Ninja, self).__init__(io.StringIO(), width)
         self.global_vars = {}
-        self.targets = {}
+        self.targets = set()
+        # Only targets written by build() have a rulehash:
+        self._target_rulehash = {}
         self.rules = {}
-        self.generator_deps = set()
+        # A dict rather than a set so the order we write them out in is
+        # stable:
+        self.generator_deps = {}
 
         self.add_generator_dep(__file__)
         self.add_generator_dep(ninja_syntax.__file__)
@@ -46,11 +71,7 @@ class Ninja(ninja_syntax.Writer):
             # configure:
             reconfigure = "%s/reconfigure-%s" % (self.builddir, ninjafile)
             self.add_target(reconfigure)
-            try:
-                os.mkdir(self.builddir)
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
+            os.makedirs(self.builddir, exist_ok=True)
             with open(reconfigure, 'w') as f:
                 f.write("#!/bin/sh\nexec %s\n" % (
                     shquote(["./" + os.path.relpath(self.regenerate_command[0])]
@@ -61,13 +82,30 @@ class Ninja(ninja_syntax.Writer):
         self.add_target("%s/.ninja_deps" % self.builddir)
         self.add_target("%s/.ninja_log" % self.builddir)
 
+        # In case we're not used as a context manager and close() is never
+        # called.  Note that this keeps unclosed Ninja objects alive until
+        # exit:
+        atexit.register(self._safe_close)
+
     def close(self):
         if not self.output.closed:
             if self.standalone:
-                self.build(self.ninjafile, "configure",
-                           list(self.generator_deps))
+                self.build(self.ninjafile, "configure", list(dict.fromkeys(
+                    os.path.relpath(x).replace('.pyc', '.py')
+                    for x in self.generator_deps)))
+            with open(self.ninjafile + '~', 'w') as f:
+                f.write(self.output.getvalue())
             super(Ninja, self).close()
             os.rename(self.ninjafile + '~', self.ninjafile)
+        atexit.unregister(self._safe_close)
+
+    def _safe_close(self):
+        try:
+            self.close()
+        except Exception:  # pylint: disable=broad-except
+            import traceback  # pylint: disable=import-outside-toplevel
+            sys.stderr.write("Failed to write %s:\n" % self.ninjafile)
+            traceback.print_exc()
 
     def __enter__(self):
         return self
@@ -75,9 +113,6 @@ class Ninja(ninja_syntax.Writer):
     def __exit__(self, _1, _2, _3):
         self.close()
 
-    def __del__(self):
-        self.close()
-
     def variable(self, key, value, indent=0):
         if indent == 0:
             if key in self.global_vars:
@@ -94,11 +129,11 @@ class Ninja(ninja_syntax.Writer):
               **kwargs):  # pylint: disable=arguments-differ
         outputs = ninja_syntax.as_list(outputs)
         inputs = ninja_syntax.as_list(inputs)
+        # All outputs of a build statement share the same rule hash:
+        rulehash = _rulehash(rule, inputs, kwargs)
         for x in outputs:
-            s = hashlib.sha256()
-            s.update(str((rule, inputs, sorted(kwargs.items()))).encode('utf-8'))
             try:
-                if self.add_target(x, s.hexdigest()) == ALREADY_WRITTEN:
+                if self.add_target(x, rulehash) == ALREADY_WRITTEN:
                     # Its a duplicate build statement, but it's identical to the
                     # last time it was written so that's ok.
                     return outputs
@@ -107,18 +142,24 @@ class Ninja(ninja_syntax.Writer):
                     return outputs
                 else:
                     raise
-        if self.debug:
-            self.output.write("# Generated by:\n")
-            stack = traceback.format_stack()[:-1]
-            for frame in stack:
-                for line in frame.split("\n"):
-                    if line:
-                        self.output.write("# ")
-                        self.output.write(line)
-                        self.output.write("\n")
+        if self.debug and _DEBUG_STACKS:
+            import traceback  # pylint: disable=import-outside-toplevel
+            lines = ["# Generated by:\n"]
+            for frame in traceback.format_stack()[:-1]:
+                lines.extend("# %s\n" % line
+                             for line in frame.split("\n") if line)
+            self.output.write("".join(lines))
+        elif self.debug:
+            frame = sys._getframe(1)  # pylint: disable=protected-access
+            while (frame.f_back is not None and
+                   frame.f_code.co_filename == __file__):
+                frame = frame.f_back
+            self.output.write("# Generated by: %s:%i\n" % (
+                frame.f_code.co_filename, frame.f_lineno))
         return super(Ninja, self).build(outputs, rule, inputs=inputs, **kwargs)
 
     def rule(self, name, *args, **kwargs):  # pylint: disable=arguments-differ
+        name = sys.intern(name)
         if name in self.rules:
             assert self.rules[name] == (args, kwargs)
         else:
@@ -149,35 +190,66 @@ class Ninja(ninja_syntax.Writer):
 
     def add_generator_dep(self, filename):
         """Cause configure to be rerun if changes are made to filename"""
-        self.generator_deps.add(
-            os.path.relpath(filename).replace('.pyc', '.py'))
+        # We only make these relative once, when writing them out in close():
+        self.generator_deps[os.path.abspath(filename)] = None
 
     def add_target(self, target, rulehash=None):
         if not target:
             raise RuntimeError("Invalid target filename %r" % target)
+        # Target names are used as keys over and over again, interning them
+        # makes those lookups cheaper.  fspath so we accept os.PathLike too,
+        # as open() does:
+        target = sys.intern(os.fspath(target))
         if target in self.targets:
-            if self.targets[target] == rulehash:
+            if self._target_rulehash.get(target) == rulehash:
                 return ALREADY_WRITTEN
             else:
                 raise DuplicateTarget(
                     "Duplicate target %r with different rule" % target)
         else:
-            self.targets[target] = rulehash
+            self.targets.add(target)
+            if rulehash is not None:
+                self._target_rulehash[target] = rulehash
             return None
 
     def write_gitignore(self, filename=None):
         if filename is None:
             filename = "%s/.gitignore" % self.builddir
         self.add_target(filename)
+        gitignore_dir = os.path.dirname(filename)
+        prefix = gitignore_dir + os.sep
+        lines = []
+        for x in sorted(self.targets):
+            # Most targets live under the directory of the .gitignore so we
+            # can avoid the comparatively expensive os.path.relpath, as long
+            # as what's left doesn't need normalising:
+            rest = x[len(prefix):]
+            if (gitignore_dir and x.startswith(prefix) and
+                    os.path.normpath(rest) == rest):
+                lines.append(rest)
+            else:
+                lines.append(os.path.relpath(x, gitignore_dir))
         with open(filename, 'w') as f:
-            for x in self.targets:
-                f.write("%s\n" % os.path.relpath(x, os.path.dirname(filename)))
+            f.write("".join("%s\n" % x for x in lines))
 
 
 class DuplicateTarget(RuntimeError):
     pass
 
 
+def _rulehash(rule, inputs, kwargs):
+    """Hash the rule, inputs and arguments of a build statement without
+    formatting the whole lot through repr() first."""
+    parts = [rule]
+    parts.extend(inputs)
+    for k, v in sorted(kwargs.items()):
+        if _is_string(v):
+            parts.append("\1%s=%s" % (k, v))
+        else:
+            parts.append("\1%s:%r" % (k, v))
+    return _HASH("\0".join(parts).encode('utf-8')).hexdigest()
+
+
 def _is_string(val):
     if sys.version_info[0] >= 3:
         str_type = str
@@ -186,6 +258,33 @@ def _is_string(val):
     return isinstance(val, str_type)
 
 
+def _bad_escape_error(text):
+    m = next(m for m in _TOKEN_RE.finditer(text) if m.group(3))
+    start = text.rfind('\n', 0, m.start()) + 1
+    end = text.find('\n', m.start())
+    if end < 0:
+        end = len(text)
+    return RuntimeError(
+        "bad $-escape (literal $ must be written as $$)\n"
+        "%s\n"
+        "%s^ near here" % (text[start:end], " " * (m.start() - start)))
+
+
+@functools.lru_cache(maxsize=4096)
+def _vars_in_one(text):
+    # Many rules share the same templates, so this is cached.
+    out = set()
+    # findall is cheaper than finditer as it doesn't create match objects.
+    # We only need those to produce a nice error message:
+    for var, braced_var, bad in _TOKEN_RE.findall(text):
+        if bad:
+            raise _bad_escape_error(text)
+        out.add(var or braced_var)
+    # $$ matches neither group:
+    out.discard('')
+    return frozenset(out)
+
+
 def vars_in(items):
     if items is None:
         return set()
@@ -193,19 +292,17 @@ def vars_in(items):
         items = [items]
     out = set()
     for text in items:
-        for x in text.split('$$'):
-            out.update(re.findall(r"\$(\w+)", x))
-            out.update(re.findall(r"\${(\w+)}", x))
-            for line in x.split('\n'):
-                m = re.search(r'\$[^_{0-9a-zA-Z]', line)
-                if m:
-                    raise RuntimeError(
-                        "bad $-escape (literal $ must be written as $$)\n"
-                        "%s\n"
-                        "%s^ near here" % (line, " " * m.start()))
+        if '$' in text:
+            out |= _vars_in_one(text)
     return out
 
 
+@functools.lru_cache(maxsize=None)
+def _dedent(text):
+    # Rules are often constructed over and over again with the same command
+    return textwrap.dedent(text)
+
+
 class Rule(object):
     def __init__(self, name, command, outputs=None, inputs=None,
                  description=None, order_only=None, implicit=None,
@@ -216,7 +313,7 @@ class Rule(object):
         if implicit is None:
             implicit = []
         self.name = name
-        self.command = textwrap.dedent(command)
+        self.command = _dedent(command)
         self.outputs = ninja_syntax.as_list(outputs)
         self.inputs = ninja_syntax.as_list(inputs)
         self.order_only = ninja_syntax.as_list(order_only)
@@ -227,6 +324,13 @@ class Rule(object):
 
         self.vars = vars_in(command).union(vars_in(inputs)).union(vars_in(outputs))
 
+        if '_args_digest' in self.vars:
+            # The digest is of str([self.name] + sorted(kwargs.items())).  The
+            # name part never changes so we hash it once here and copy the
+            # state in build():
+            self._digest_seed = hashlib.sha256(
+                ("[%r" % (self.name,)).encode('utf-8'))
+
         if description is None:
             description = "%s(%s)" % (self.name, ", ".join(
                 "%s=$%s" % (x, x) for x in self.vars))
@@ -255,19 +359,31 @@ class Rule(object):
                             (self.name, ", ".join(v - self.vars)))
 
         if '_args_digest' in self.vars:
-            s = hashlib.sha256()
-            s.update(str([self.name] + sorted(kwargs.items())).encode('utf-8'))
+            s = self._digest_seed.copy()
+            if kwargs:
+                s.update((", " + repr(sorted(kwargs.items()))[1:]).encode(
+                    'utf-8'))
+            else:
+                s.update(b"]")
             kwargs['_args_digest'] = s.hexdigest()[:7]
 
+        expanded = {}
+
+        def expand(x):
+            # Templates without a $ are common and need no expanding, and the
+            # same template may appear more than once in a rule:
+            if '$' not in x:
+                return x
+            if x not in expanded:
+                expanded[x] = ninja_syntax.expand(x, ninja.global_vars, kwargs)
+            return expanded[x]
+
         if self.outputs:
-            outputs.extend(ninja_syntax.expand(x, ninja.global_vars, kwargs)
-                           for x in self.outputs)
+            outputs.extend(expand(x) for x in self.outputs)
         if self.inputs:
-            inputs.extend(ninja_syntax.expand(x, ninja.global_vars, kwargs)
-                          for x in self.inputs)
+            inputs.extend(expand(x) for x in self.inputs)
         if self.implicit:
-            implicit.extend(ninja_syntax.expand(x, ninja.global_vars, kwargs)
-                          for x in self.implicit)
+            implicit.extend(expand(x) for x in self.implicit)
 
         ninja.newline()
         outputs = ninja.build(